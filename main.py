@@ -1,6 +1,6 @@
 """
 Greenhouse project - Adaptive humidification
-Version 12. PID-regulator (Only P and I components implemented).
+Version 13. PID-regulator (the derivative term is off by default, C_D = 0.0).
 
 E.g.
 https://www.amazon.com/Humidity-Controller-Inkbird-Humidistat-Pre-wired/dp/B01J1E5LWM
@@ -28,6 +28,15 @@ where
 proportional_error = current_humidity - TARGET_HUMIDITY
 integral_error = \sum_{0}^{now}(proportional_error)
 (sum of proportional errors since start of device).
+Since version 13 this is computed in the incremental (velocity) form:
+output = last_output - C_P * (proportional_error - last_proportional_error)
+                     - C_I * proportional_error
+                     - C_D * (proportional_error - 2 * last_proportional_error
+                              + second_last_proportional_error)
+which is the same as above as long as the output is not clipped. The last
+line is the change of a derivative term -C_D * (proportional_error -
+last_proportional_error). It is zero in the first cycle, as there is no
+earlier reading. With the default C_D = 0.0 the controller is a PI-controller.
 
 Reset
 If the space is vented (e.g. door open) while the software is running, the
@@ -44,16 +53,30 @@ be out of balance for 30 minutes!
 95% RH: Keeping the space open for 5 minutes will require 1 hour to reset.
 99% RH: Keeping the space open for 5 minutes will require 2.5 hours to reset
 (with the hack of adding 1.0 to the error when hitting max humidity).
--There clearly is a need to handle this better. Otherwise the device will
-need to be reset every time the space is opened. The code now resets the
-controller if it has been hitting max humidity for 15 minutes. This is a
-step in the right direction, but feels hacky. Reducing the time from 15 minutes
-is also a bit risky, as setting the device for 99% RH took 10 minutes of
+-There clearly was a need to handle this better. Otherwise the device would
+need to be reset every time the space was opened. Version 12 reset the
+controller once it had been hitting max humidity for 15 minutes. This was a
+step in the right direction, but felt hacky, and reducing the time from 15
+minutes was risky, as setting the device for 99% RH took 10 minutes of
 hitting >99.9% RH before it started stabilizing.
+Version 13 computes the controller in the incremental form and clips the
+output to [0, 100] instead of the integral error, so no error accumulates
+while the humidifier is already on 100% of the time. The controller starts
+correcting as soon as the humidity passes the target, and the 15 minute reset
+was removed.
+
+Logging
+Version 13 changed the last column of log.csv from "Integral error" to
+"Rate change" (the change of the humidification rate in one cycle, two
+decimals). New rows are appended to an existing log.csv under its old header,
+so move or delete a log.csv from an earlier version before updating.
 """
 
+import gc
+import os
 import time
-from machine import Pin
+from machine import Pin, Timer
+from micropython import const
 from DHT22 import DHT22
 
 # Desired humidity in percent:
@@ -74,137 +97,265 @@ C_P = 2.0  # Coefficient for proportional error. 0.25 implies that an error of
 C_I = 0.03  # Coefficient for integral error. A C_I of 0.01 indicates that an
 # error of 40% over 100 seconds (10 cycles) would change the humidification rate
 # by 4%.
+C_D = 0.0  # Coefficient for derivative error. A C_D of 1.0 indicates that an
+# increase in humidity of 1% between two cycles would reduce the humidification
+# rate by 1%.
 
 # Time for one cycle. The humidifier and the ventilator are turned on and off
 # once during this time and the humidification rate is re-estimated every cycle.
-CYCLE_TIME = 10  # seconds
+CYCLE_TIME = const(10)  # seconds
+# Set to False to disable logging to flash altogether:
+LOG_ENABLED = True
 # Log info every 10 minutes and only temperature and humidity
 SPARSE_LOGGING = True
 LOG_COUNT = 0
+SPARSE_LOG_HEADER = b'"Humidity","Temperature"\n'
+# The DHT22 resolves 0.1% RH and 0.1 C, so readings are logged with one
+# decimal.
+SPARSE_LOG_ROW = '"%.1f","%.1f"\n'
+# Rows of the detailed log are collected in RAM and written to flash
+# in chunks of LOG_BUFFER_SIZE bytes (two 256 byte flash pages). This
+# saves flash wear, but rows still in the buffer are lost on power loss.
+LOG_BUFFER_SIZE = const(512)  # bytes
+LOG_BUFFER = bytearray()
+LOG_HEADER = b'"Humidity","Rate","Proportional error","Rate change"\n'
+# The rate change is logged with two decimals as the integral term
+# alone is often below 0.1% per cycle.
+LOG_ROW = '"%.1f","%.1f","%.1f","%.2f"\n'
+# Printed every cycle when control_humidity is run with verbose=True:
+VERBOSE_FORMAT = ("=" * 40 + "\n"
+                  "Humidity: %s%% RH\n"
+                  "Proportional error: %s\n"
+                  "Rate change: %s\n"
+                  "Humidification rate: %s%% of cycle\n"
+                  "Fresh air rate: %s%% of cycle\n"
+                  "Cycle time: %s s")
 
 # Hardware, connection pins for relays:
 # Seems there is a clash with the screen (it is also using pins 6 and 7).
 # I am thinking pins 20 and 21 should be safe choices.
-RELAY_1_PIN = 6  # This is the relay above the usb-port
-RELAY_2_PIN = 7  # This is the relay opposite from the usb-port
+RELAY_1_PIN = const(6)  # This is the relay above the usb-port
+RELAY_2_PIN = const(7)  # This is the relay opposite from the usb-port
+# Shortest time a relay is switched on or off for. The relays are mechanical,
+# so shorter pulses are skipped (100 ms is 1% of a 10 second cycle).
+RELAY_MIN_SWITCH_TIME = const(100)  # ms
+# Data pin of the DHT22 humidity and temperature sensor:
+DHT22_PIN = const(3)
 
 
-def control_humidity(verbose=False, test=False):
+def control_humidity(verbose=False, test=False, cycle_time=CYCLE_TIME):
     """
     A function for controlling relay (and humidifier). Currently the
     mist from a humidifier is directed into a chamber with a little
     water on the bottom and the stones of a bubbler. The humidifier is
-    on for humidification_rate * CYCLE_TIME, and the ventilator is
-    on for FAE_RATE * CYCLE_TIME.
+    on for humidification_rate * cycle_time, and the ventilator is
+    on for FAE_RATE * cycle_time.
 
     Args:
     verbose (bool): Prints out metrics every cycle
     test (bool): If True, uses a fake generator to generate sensor
      readings. For testing purposes (without device).
+    cycle_time (int): Time for one cycle in seconds.
     """
     # Humidifier runs in short cycles to keep humidity more constant.
     # See parameters at beginning of script for more details.
-    if CYCLE_TIME < 2:
-        print("Cycle time must be equal to or above 2 seconds to " +
-              "ensure that the humidity sensor is reset every cycle.")
+    # Cycles end on fixed deadlines, so a read that starts late can be
+    # followed by one that starts on time, i.e. reads can come slightly
+    # less than cycle_time apart.
+    if cycle_time <= 2:
+        print("Cycle time must be above 2 seconds to ensure that the " +
+              "humidity sensor is reset every cycle.")
         raise Exception
 
     # Initialize relays:
-    relay_1 = Pin(RELAY_1_PIN, Pin.OUT)
-    relay_2 = Pin(RELAY_2_PIN, Pin.OUT)
+    relay_1 = TimedRelay(RELAY_1_PIN)
+    relay_2 = TimedRelay(RELAY_2_PIN)
 
     # Initialize sensor:
     if not test:
-        sensor = DHT22(Pin(3, Pin.IN, Pin.PULL_UP))
+        sensor = DHT22(Pin(DHT22_PIN, Pin.IN, Pin.PULL_UP))
     else:
         # For testing purposes
         sensor = FakeSensor()
 
-    # Initialize cumulative (integral!) error:
-    integral_err = 0.0
-    reset_count = 0
+    # Open the log once and keep appending to the same handle:
+    if LOG_ENABLED:
+        if SPARSE_LOGGING:
+            log_handle = open_log('sparse_log.csv', SPARSE_LOG_HEADER)
+        else:
+            log_handle = open_log('log.csv', LOG_HEADER)
+
+    # Initialize controller state. With these the first output equals
+    # that of the non-incremental form:
+    humidification_rate = 0.0
+    last_proportional_err = 0.0
+    # Derivative error (change of the proportional error) of the last
+    # cycle. There is no earlier reading before the first cycle, so the
+    # derivative error starts at zero rather than at the first error.
+    last_derivative_err = 0.0
+    first_cycle = True
+
+    # Bind parameters to local names once, as local lookups are
+    # cheaper than global lookups in the loop below. The ventilator
+    # on-time and the cycle length do not change between cycles.
+    target_humidity = TARGET_HUMIDITY
+    c_p = C_P
+    c_i = C_I
+    c_d = C_D
+    ms_per_rate = cycle_time * 10  # on-time in ms per percent of cycle
+    ventilator_ms = int(FAE_RATE * ms_per_rate)
+    cycle_ms = int(cycle_time * 1000)
+    read_sensor = sensor.read
 
     # Sleep 2 seconds to ensure sensor is ready.
     time.sleep_ms(2000)
+    cycle_start = time.ticks_ms()
     while True:
         # Continuous loop. Read sensor to estimate parameters
-        temperature, current_humidity = sensor.read()
+        temperature, current_humidity = read_sensor()
 
         # Proportional error:
-        proportional_err =  current_humidity - TARGET_HUMIDITY
-        if current_humidity > 99.9 and current_humidity > TARGET_HUMIDITY:
+        proportional_err =  current_humidity - target_humidity
+        if current_humidity > 99.9 and current_humidity > target_humidity:
             # I.e. the DHT22 outputs max value
             # Add error to compensate for the discontinuous point
             # at and above 99.90001. This could potentially make
             # the device faster move away from humidity above
             # 99.9%.
             proportional_err += 1.0
-            reset_count += 1
-            if reset_count > 90:
-                # The space has been externally vented and the
-                # PID-controller needs to be reset. This is not meant
-                # to happen accidentally, so the error should
-                # continue for 15 minutes (900 seconds) before
-                # this is called.
-                integral_err = 0.0
-                reset_count = 0
-        else:
-            reset_count = 0
-
-        # Integral error. The integral error is estimated as a cumulative
-        # sum (discrete approximation of integral).
-        integral_err += proportional_err
-        # The min-max is meant to clip the error at the point where
-        # the integral part would keep the humidifier on for 100% of
-        # the time or 0% of the time. If the setup contained a dehumidifier,
-        # and the target humidity was below ambient air humidity, then
-        # positive values should also be allowed.
-        integral_err = min(0.0, max(-1 / C_I * 100, integral_err))
 
         # Combine the results:
-        # PI-control (no derivative term)
-        humidification_rate = - integral_err * C_I - proportional_err * C_P
+        # PID-control in incremental form. The changes of the proportional
+        # and derivative terms and this cycle's contribution to the integral
+        # term are added to the previous output.
+        error_change = proportional_err - last_proportional_err
+        derivative_err = 0.0 if first_cycle else error_change
+        rate_change = (- error_change * c_p
+                       - proportional_err * c_i
+                       - (derivative_err - last_derivative_err) * c_d)
+        last_proportional_err = proportional_err
+        last_derivative_err = derivative_err
+        first_cycle = False
 
         # Humidifier cannot be off for more than 0% of the time, nor on for more
-        # than 100% of the time:
-        humidification_rate = max(0.0, min(100.0, humidification_rate))
+        # than 100% of the time. Clipping the output (rather than the integral
+        # error) means no error builds up while the humidifier is saturated.
+        humidification_rate += rate_change
+        if humidification_rate > 100.0:
+            humidification_rate = 100.0
+        elif humidification_rate < 0.0:
+            humidification_rate = 0.0
         
         # Log details
-        if SPARSE_LOGGING:
-            log_sparse_details(current_humidity, temperature)
-        else:
-            log_details(current_humidity, humidification_rate, proportional_err, integral_err)
+        if LOG_ENABLED:
+            if SPARSE_LOGGING:
+                log_sparse_details(log_handle, current_humidity, temperature)
+            else:
+                log_details(log_handle, current_humidity, humidification_rate,
+                            proportional_err, rate_change)
 
         if verbose:
-            print("=" * 40)
-            print("Humidity: {}% RH".format(current_humidity))
-            print("Proportional error: {}".format(proportional_err))
-            print("Integral error: {}".format(integral_err))
-            print("Humidification rate: {}% of cycle".format(humidification_rate))
-            print("Fresh air rate: {}% of cycle".format(FAE_RATE))
-            print("Cycle time: {} s".format(CYCLE_TIME))
+            print(VERBOSE_FORMAT % (current_humidity,
+                                    proportional_err,
+                                    rate_change,
+                                    humidification_rate,
+                                    FAE_RATE,
+                                    cycle_time))
 
         # Settings are re-estimated every cycle.
-        sleep_time = CYCLE_TIME * 10 # sleep time as ms as there are 1000 iterations.
-        for i in range(100):
-            # Splitting one cycle in 1000 iterations
-            if i < humidification_rate:
-                relay_1.value(1)
-            else:
-                relay_1.value(0)
-            if i < FAE_RATE:
-                # Keep ventilator running
-                relay_2.value(1)
-            else:
-                relay_2.value(0)
-            time.sleep_ms(int(sleep_time))
-        
+        # The relays are switched off by their timers, so the loop only
+        # needs to sleep until the next cycle.
+        relay_1.start(int(humidification_rate * ms_per_rate), cycle_start, cycle_ms)
+        relay_2.start(ventilator_ms, cycle_start, cycle_ms)
+        # The next cycle starts when this one was scheduled to end, so the
+        # time spent reading the sensor and logging does not add up.
+        cycle_start = time.ticks_add(cycle_start, cycle_ms)
+        # Collect garbage now, while there is time to spare, so that an
+        # automatic collection does not interrupt the timing sensitive
+        # read of the DHT22 at the start of the next cycle.
+        gc.collect()
+        if time.ticks_diff(cycle_start, time.ticks_ms()) < 0:
+            # This cycle overran the next one. Skip the missed cycle and
+            # start the next one now rather than running cycles back to
+            # back to catch up.
+            cycle_start = time.ticks_ms()
+        sleep_until(cycle_start)
+
+
+class TimedRelay():
+    """
+    Relay that is switched on at the start of a cycle and switched off
+    by a one-shot timer once its share of the cycle has passed. The CPU
+    is free in the meantime and the relay changes state at most twice
+    per cycle.
+
+    The hardware PWM of the RP2040 is not used for this: its lowest
+    frequency is about 7.5 Hz (125 MHz / 256 / 65536), far from one
+    period per CYCLE_TIME, and a mechanical relay cannot follow PWM
+    at that rate anyway.
+    """
+    def __init__(self, pin_number):
+        self.pin = Pin(pin_number, Pin.OUT)
+        self.timer = Timer()
+        # Bind the callback once rather than every cycle.
+        self.switch_off = self._switch_off
+
+    def _switch_off(self, timer):
+        self.pin.value(0)
+
+    def start(self, on_ms, cycle_start, cycle_ms):
+        """
+        Switches the relay on and schedules it to be switched off
+        on_ms after cycle_start. A relay that would be off for less
+        than RELAY_MIN_SWITCH_TIME is left on, and one that would be
+        on for less than that is left off.
+
+        Args:
+        on_ms (int): In [0, cycle_ms]. Time the relay stays on.
+        cycle_start (int): Start of the cycle as given by time.ticks_ms().
+        cycle_ms (int): Length of one cycle in ms.
+        """
+        self.timer.deinit()
+        if on_ms > cycle_ms - RELAY_MIN_SWITCH_TIME:
+            self.pin.value(1)
+            return
+        # Time left until the relay should be switched off. The relay
+        # is switched on only after the sensor has been read, so this
+        # can be much shorter than on_ms.
+        remaining_ms = time.ticks_diff(time.ticks_add(cycle_start, on_ms),
+                                       time.ticks_ms())
+        if remaining_ms < RELAY_MIN_SWITCH_TIME:
+            self.pin.value(0)
+            return
+        self.pin.value(1)
+        self.timer.init(mode=Timer.ONE_SHOT, period=remaining_ms,
+                        callback=self.switch_off)
+
+
+def sleep_until(deadline):
+    """
+    Sleeps until time.ticks_ms() reaches deadline. Returns immediately
+    if the deadline has already passed.
+
+    Args:
+    deadline (int): Time as given by time.ticks_ms() or time.ticks_add().
+    """
+    delay = time.ticks_diff(deadline, time.ticks_ms())
+    if delay > 0:
+        time.sleep_ms(delay)
 
-def log_sparse_details(current_humidity,
+
+def log_sparse_details(handle,
+                       current_humidity,
                        current_temperature):
     """
     Sparse version of logging. Meant to save data
     only every 10 minutes to save space.
+
+    Args:
+    handle (file): Log file opened with open_log()
+    current_humidity (float): Last measured humidity
+    current_temperature (float): Last measured temperature
     """
     global LOG_COUNT
     LOG_COUNT += 1
@@ -213,57 +364,78 @@ def log_sparse_details(current_humidity,
         # Write to file.
         LOG_COUNT = 0
         try:
-            with open('sparse_log.csv', 'r') as handle:
-                # Just see if the file exists.
-                # Throws an error if it does not.
-                pass
-            with open('sparse_log.csv', 'a') as handle:
-                handle.write('"{}","{}"\n'.format(current_humidity,
-                                                current_temperature))
+            handle.write((SPARSE_LOG_ROW % (current_humidity,
+                                            current_temperature)).encode())
+            handle.flush()
         except OSError:
-            # File did not exist. Write headers first.
-            with open('sparse_log.csv', 'a') as handle:
-                handle.write('"Humidity","Temperature"\n')
-                handle.write('"{}","{}"\n'.format(current_humidity,
-                                                current_temperature))
+            # E.g. the flash is full. Logging must not stop the controller.
+            pass
+
+
+def open_log(filename, header):
+    """
+    Opens a log file for appending in binary mode. The existence of
+    the file is only checked here, so that the logging functions can
+    keep writing to the same handle every cycle.
+
+    Args:
+    filename (str): Name of the log file
+    header (bytes): Header row written if the file does not exist yet.
+
+    Returns:
+    File handle opened for appending.
+    """
+    try:
+        # Throws an error if the file does not exist.
+        os.stat(filename)
+    except OSError:
+        # Create file for logging:
+        handle = open(filename, 'wb')
+        handle.write(header)
+        # Make sure the header reaches flash before the first rows,
+        # which may be buffered for a long time.
+        handle.flush()
+        return handle
+    return open(filename, 'ab')
 
 
-def log_details(current_humidity,
+def log_details(handle,
+                current_humidity,
                 humidification_rate,
                 proportional_err,
-                integral_err):
+                rate_change):
     """
-    Function for logging info on humidity and state.
+    Function for logging info on humidity and state. Rows are
+    buffered and written to the file LOG_BUFFER_SIZE bytes at a time.
     
     Args:
+    handle (file): Log file opened with open_log()
     current_humidity (float): Last measured humidity
     humidification_rate (float): In [0, 100] [%]. How
      large part of the cycle the humidifier stays on.
     proportional_err (float): Last measured deviation from target
      humidity.
-    integral (float): Accumulated error
+    rate_change (float): Change of the humidification rate computed
+     by the controller this cycle (before clipping).
     """
-    try:
-        # First check for existence of file. If it exists,
-        # the below overwrites it (like when you are plugging
-        # the Pico to your computer and it does not go into
-        # REPL-model).
-        with open('log.csv', 'r') as handle:
-            # Do nothing. Throws an error if file does not exist.
+    global LOG_BUFFER
+    LOG_BUFFER += (LOG_ROW % (current_humidity,
+                              humidification_rate,
+                              proportional_err,
+                              rate_change)).encode()
+    if len(LOG_BUFFER) >= LOG_BUFFER_SIZE:
+        try:
+            handle.write(LOG_BUFFER)
+            handle.flush()
+        except OSError:
+            # E.g. the flash is full. The rows are dropped rather than
+            # letting the buffer grow or stopping the controller.
             pass
-        with open('log.csv', 'a') as handle:
-            handle.write('"{}","{}","{}","{}"\n'.format(current_humidity,
-                                                        humidification_rate,
-                                                        proportional_err,
-                                                        integral_err))
-    except OSError:
-        # Create file for logging:
-        with open('log.csv', 'w') as handle:
-            handle.write('"Humidity","Rate","Proportional error","Integral error"\n')
-            handle.write('"{}","{}","{}","{}"\n'.format(current_humidity,
-                                                        humidification_rate,
-                                                        proportional_err,
-                                                        integral_err))
+        LOG_BUFFER = bytearray()
+
+
+# Reading (temperature, humidity) returned by FakeSensor:
+FAKE_READING = (23, 55)
 
 
 class FakeSensor():
@@ -276,17 +448,15 @@ class FakeSensor():
         pass
 
     def read(self):
-        # Make up some reasonable number pair
-        return 23, 55
+        # Some reasonable number pair, the same tuple every time
+        return FAKE_READING
 
 
 def test():
     """
     Function for calling above with suitable test parameters.
     """
-    global CYCLE_TIME
-    CYCLE_TIME = 2.0
-    control_humidity(True, True)
+    control_humidity(True, True, cycle_time=3)
 
 
 if __name__ == '__main__':